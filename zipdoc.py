@@ -51,6 +51,16 @@ Configuration::
     **.dotx = zipdocdecode
     **.dotm = zipdocdecode
     **.odt = zipdocdecode
+
+    The compression level used by the decode filter can be set in the
+    ``zipdoc`` section. It defaults to 10 with libdeflate (valid levels are
+    0 to 12), 2 with ISA-L (0 to 3) and 3 with zlib (0 to 9), see
+    "Faster compression" below. Levels 0 to 3 are valid with all of them,
+    other levels are rejected with a configuration error if the library in
+    use does not support them. E.g. for the fastest compression:
+
+    [zipdoc]
+    level = 1
     
 How it works::
 
@@ -91,7 +101,8 @@ Notes and Tips::
     
     This extensions makes no assumptions about the specific format of the
     filtered zip file. Thus any file that is a valid zip archive can be
-    processed with this filter.
+    processed with this filter. Only archives that do not start with a zip
+    record, e.g. self-extracting archives, are stored unfiltered.
     
     Checking if the extension works
     
@@ -100,101 +111,544 @@ Notes and Tips::
     This can be used to check if the extension is working and which files are
     processed.
     
+    Faster compression
+    
+    If python-libdeflate (the ``deflate`` package) is installed in the
+    Python environment Mercurial runs in, it is used instead of zlib for
+    compressing the documents in the decode filter. This is faster and
+    results in slightly smaller files. Otherwise python-isal (the ``isal``
+    package) is used if it is installed, which is faster than zlib as well.
+    Without either of them zlib is used.
+    
 '''
 
+import concurrent.futures
+import functools
+import itertools
+import os
+import struct
+import threading
 import zipfile
+import zlib
 
-from mercurial import util, ui, hg
+from mercurial import util, ui, hg, error, registrar
 from mercurial.i18n import _
 
 from io import BytesIO 
 
+configtable = {}
+configitem = registrar.configitem(configtable)
+
+# compression level of the decode filter, None for the library's default
+configitem(b'zipdoc', b'level',
+    default=None,
+)
+
+try:
+    # python-libdeflate: roughly twice as fast as zlib for DEFLATE and CRC-32
+    import deflate
+except ImportError:
+    deflate = None
+
+try:
+    # python-isal: zlib compatible API on top of ISA-L's SIMD DEFLATE
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+# marker inserted between adjacent XML tags to get one tag per line in diffs
+_XMLTAGS = b"><"
+_XMLSPLIT = b">\r\n <"
+
+# every spelling of the .xml extension, so member names can be tested
+# without creating a lowercased copy of each of them
+_XMLSUFFIXES = tuple("." + "".join(chars)
+                     for chars in itertools.product("xX", "mM", "lL"))
+
+# ZIP record layouts, see APPNOTE.TXT (same formats as the zipfile module)
+_LOCALHEADER = struct.Struct("<4s2B4HL2L2H")
+_CENTRALHEADER = struct.Struct("<4s4B4HL2L5H2L")
+_ENDRECORD = struct.Struct("<4s4H2LH")
+_ZIP64_ENDRECORD = struct.Struct("<4sQ2H2L4Q")
+_ZIP64_LOCATOR = struct.Struct("<4sLQL")
+_EXTRAHEADER = struct.Struct("<2H")
+# sizes and counts above which zipfile switches to ZIP64 records
+_ZIP64_LIMIT = zipfile.ZIP64_LIMIT
+_ZIP_FILECOUNT_LIMIT = zipfile.ZIP_FILECOUNT_LIMIT
+_ZIP64_VERSION = 45
+# field values telling that the actual value is in the ZIP64 records
+_ZIP64_MARKER = 0xFFFFFFFF
+_ZIP64_COUNT_MARKER = 0xFFFF
+# the end record may be followed by an archive comment of up to 64 KiB
+_MAX_COMMENT = 0xFFFF
+
+if deflate is not None:
+    _BACKEND = b"libdeflate"
+    _LEVELS = range(0, 13)
+    # libdeflate's level 10 is both faster and smaller than zlib's default
+    _LEVEL = 10
+
+    def _deflate(data, level):
+        '''Compress data to a raw DEFLATE stream as used in ZIP archives.'''
+        return deflate.deflate_compress(data, level)
+
+    def _inflate(data, size):
+        '''Decompress a raw DEFLATE stream of size uncompressed bytes.'''
+        return deflate.deflate_decompress(data, size)
+else:
+    if isal_zlib is not None:
+        _zlib = isal_zlib
+        _BACKEND = b"ISA-L"
+        _LEVELS = range(0, 4)
+        _LEVEL = isal_zlib.ISAL_DEFAULT_COMPRESSION
+    else:
+        _zlib = zlib
+        _BACKEND = b"zlib"
+        _LEVELS = range(0, 10)
+        # the decode filter runs on every update, so trade a little size
+        # for speed compared to zlib's default level 6
+        _LEVEL = 3
+
+    try:
+        # zlib.compress accepts wbits since Python 3.11, isal_zlib always
+        _zlib.compress(b"", 0, -zlib.MAX_WBITS)
+    except TypeError:
+        def _deflate(data, level):
+            '''Compress data to a raw DEFLATE stream as used in ZIP
+            archives.'''
+            compressor = _zlib.compressobj(level, zlib.DEFLATED,
+                                           -zlib.MAX_WBITS)
+            return compressor.compress(data) + compressor.flush()
+    else:
+        # zlib cannot reset a stream after Z_FINISH and a shared compressor
+        # would not work with the thread pool, so one-shot compression is
+        # the cheapest option: it does without a compressobj per member and
+        # without concatenating the outputs of compress() and flush()
+        def _deflate(data, level):
+            '''Compress data to a raw DEFLATE stream as used in ZIP
+            archives.'''
+            return _zlib.compress(data, level, -zlib.MAX_WBITS)
+
+    def _inflate(data, size):
+        '''Decompress a raw DEFLATE stream of size uncompressed bytes.'''
+        return _zlib.decompress(data, -zlib.MAX_WBITS, size)
+
+# libdeflate and ISA-L compute CRC-32 with carry-less multiplication
+# (PCLMULQDQ) instead of zlib's table driven loop
+if deflate is not None:
+    _crc32 = deflate.crc32
+elif isal_zlib is not None:
+    _crc32 = isal_zlib.crc32
+else:
+    _crc32 = zlib.crc32
+
+def _splitxml(data):
+    '''Split adjacent XML tags of an archive member onto separate lines.
+
+    Returns data itself if there are no adjacent tags, e.g. for already
+    pretty printed XML.'''
+    # the containment test stops at the first match, so it is next to free
+    # for XML that needs splitting.
+    if _XMLTAGS not in data:
+        return data
+    # bytes.replace counts the matches with a memchr based search first and
+    # then fills a single output buffer of the final size, so there is no
+    # need for a native helper here. A precompiled re.sub() is about six
+    # times slower for this literal pattern.
+    return data.replace(_XMLTAGS, _XMLSPLIT)
+
+def _joinxml(data):
+    '''Revert the line splitting done by _splitxml.
+
+    Returns data itself if it contains no split markers.'''
+    if _XMLSPLIT not in data:
+        return data
+    # faster than collecting the slices between markers with bytes.find
+    # and joining them
+    return data.replace(_XMLSPLIT, _XMLTAGS)
+
+# thread pool shared by all filter calls, created on first use
+# the lock keeps concurrent filter calls (Mercurial's threaded workers on
+# Windows) from creating a pool each
+_executor = None
+_executorlock = threading.Lock()
+
+def _map(fn, items):
+    '''Apply fn to every item in the thread pool, keeping the order.
+
+    DEFLATE and CRC-32 release the GIL, so the members of an archive are
+    processed in parallel.'''
+    global _executor
+    if len(items) < 2:
+        return [fn(item) for item in items]
+    with _executorlock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(os.cpu_count())
+        executor = _executor
+    return list(executor.map(fn, items))
+
+def _forgetexecutor():
+    '''Drop the thread pool in a forked child (e.g. a Mercurial worker):
+    its threads only exist in the parent process. The lock is replaced as
+    well, it may have been held by another thread at the time of the fork.'''
+    global _executor, _executorlock
+    _executor = None
+    _executorlock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forgetexecutor)
+
+def _member(info, data, payload, original):
+    '''Record size and checksum of data in info, payload is data compressed
+    with the info's compress_type.
+
+    original is the member as read from the archive. Its checksum has been
+    verified while reading, so it is only recomputed if data differs.'''
+    info.file_size = len(data)
+    info.compress_size = len(payload)
+    # _splitxml and _joinxml return their argument if there is nothing to
+    # rewrite
+    if data is not original:
+        info.CRC = _crc32(data)
+    return info, payload
+
+def _stripzip64(extra):
+    '''Remove the ZIP64 field from the extra field data of a member, the
+    writer adds a new one if it is still needed.'''
+    fields = []
+    pos = 0
+    while pos + _EXTRAHEADER.size <= len(extra):
+        headerid, size = _EXTRAHEADER.unpack_from(extra, pos)
+        end = pos + _EXTRAHEADER.size + size
+        if headerid == 1:
+            fields.append(extra[:pos])
+            extra = extra[end:]
+            pos = 0
+        else:
+            pos = end
+    return b"".join(fields) + extra
+
+def _writezip(members):
+    '''Build a ZIP archive from (ZipInfo, payload) pairs made by _member.
+
+    zipfile can only write members it compresses itself, so the records
+    are assembled here the same way zipfile does it, including the ZIP64
+    records for large archives.'''
+    # collect the pieces and join them once at the end: this allocates the
+    # result in its final size instead of growing a BytesIO buffer and
+    # copying it again in getvalue()
+    # the result has to be bytes, Mercurial does not accept a bytearray or
+    # memoryview from a filter (e.g. diff fails on it)
+    chunks = []
+    centraldir = []
+    offset = 0
+    for info, payload in members:
+        # same flags as zipfile.ZipFile.writestr: sizes are known in advance
+        # so only the UTF-8 flag for non-ASCII names is needed
+        try:
+            filename = info.filename.encode("ascii")
+            flag_bits = 0
+        except UnicodeEncodeError:
+            filename = info.filename.encode("utf-8")
+            flag_bits = 0x800
+        dt = info.date_time
+        dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+        dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+        extra = _stripzip64(info.extra)
+        extract_version = info.extract_version
+        create_version = info.create_version
+        compress_size = info.compress_size
+        file_size = info.file_size
+        localextra = centralextra = extra
+        zip64 = []
+        if max(file_size, compress_size) > _ZIP64_LIMIT:
+            localextra = struct.pack("<HHQQ", 1, 16, file_size,
+                                     compress_size) + extra
+            zip64 += (file_size, compress_size)
+            compress_size = file_size = _ZIP64_MARKER
+        header_offset = offset
+        if offset > _ZIP64_LIMIT:
+            zip64.append(offset)
+            header_offset = _ZIP64_MARKER
+        if zip64:
+            centralextra = struct.pack("<HH" + "Q" * len(zip64), 1,
+                                       8 * len(zip64), *zip64) + extra
+            extract_version = max(_ZIP64_VERSION, extract_version)
+            create_version = max(_ZIP64_VERSION, create_version)
+        header = (extract_version, info.reserved, flag_bits,
+                  info.compress_type, dostime, dosdate, info.CRC,
+                  compress_size, file_size, len(filename))
+        chunks += (_LOCALHEADER.pack(b"PK\x03\x04", *header,
+                                     len(localextra)),
+                   filename, localextra, payload)
+        centraldir += (_CENTRALHEADER.pack(b"PK\x01\x02",
+                           create_version, info.create_system, *header,
+                           len(centralextra), len(info.comment), 0,
+                           info.internal_attr,
+                           info.external_attr or 0o600 << 16, header_offset),
+                       filename, centralextra, info.comment)
+        offset += (_LOCALHEADER.size + len(filename) + len(localextra)
+                   + info.compress_size)
+    centraldir_size = sum(len(chunk) for chunk in centraldir)
+    chunks += centraldir
+    count = len(members)
+    if (count > _ZIP_FILECOUNT_LIMIT or offset > _ZIP64_LIMIT
+            or centraldir_size > _ZIP64_LIMIT):
+        chunks.append(_ZIP64_ENDRECORD.pack(b"PK\x06\x06",
+                _ZIP64_ENDRECORD.size - 12, _ZIP64_VERSION, _ZIP64_VERSION,
+                0, 0, count, count, centraldir_size, offset))
+        chunks.append(_ZIP64_LOCATOR.pack(b"PK\x06\x07", 0,
+                                          offset + centraldir_size, 1))
+        chunks.append(_ENDRECORD.pack(b"PK\x05\x06", 0, 0,
+                                      min(count, _ZIP64_COUNT_MARKER),
+                                      min(count, _ZIP64_COUNT_MARKER),
+                                      min(centraldir_size, _ZIP64_MARKER),
+                                      min(offset, _ZIP64_MARKER), 0))
+    else:
+        chunks.append(_ENDRECORD.pack(b"PK\x05\x06", 0, 0, count, count,
+                                      centraldir_size, offset, 0))
+    return b"".join(chunks)
+
+def _infolist(s):
+    '''Return a ZipInfo for every member of the ZIP archive s.
+
+    The central directory is parsed straight from s instead of through
+    zipfile and a BytesIO. Raises zipfile.BadZipFile if s is not a ZIP
+    archive.'''
+    # documents start with their first member (or with the end record if
+    # they are empty), so anything else is rejected without searching the
+    # last 64 KiB for the end record
+    if (len(s) < _ENDRECORD.size
+            or s[:4] not in (b"PK\x03\x04", b"PK\x05\x06")):
+        raise zipfile.BadZipFile("File is not a zip file")
+    pos = s.rfind(b"PK\x05\x06", max(0, len(s) - _ENDRECORD.size
+                                        - _MAX_COMMENT))
+    if pos < 0 or len(s) - pos < _ENDRECORD.size:
+        raise zipfile.BadZipFile("File is not a zip file")
+    endrec = _ENDRECORD.unpack_from(s, pos)
+    count, size, offset = endrec[4:7]
+    if (count == _ZIP64_COUNT_MARKER or offset == _ZIP64_MARKER
+            or size == _ZIP64_MARKER
+            or pos >= _ZIP64_LOCATOR.size
+            and s[pos - _ZIP64_LOCATOR.size:pos - 16] == b"PK\x06\x07"):
+        # ZIP64 archives are rare for documents, leave them to zipfile
+        with zipfile.ZipFile(BytesIO(s), "r") as zipped:
+            return zipped.infolist()
+    # archives with data prepended (e.g. self-extractors) are rejected by
+    # the signature check above; like zipfile, still correct all offsets
+    # if the central directory is not where the end record says it is
+    concat = pos - size - offset
+    if concat < 0:
+        raise zipfile.BadZipFile("Bad offset for central directory")
+    infos = []
+    pos = offset + concat
+    end = pos + size
+    while pos < end:
+        try:
+            centdir = _CENTRALHEADER.unpack_from(s, pos)
+        except struct.error:
+            raise zipfile.BadZipFile("Truncated central directory")
+        if centdir[0] != b"PK\x01\x02":
+            raise zipfile.BadZipFile("Bad magic number for central directory")
+        (create_version, create_system, extract_version, reserved,
+         flag_bits, compress_type, dostime, dosdate, crc, compress_size,
+         file_size, namelen, extralen, commentlen, volume, internal_attr,
+         external_attr, header_offset) = centdir[1:]
+        if _ZIP64_MARKER in (compress_size, file_size, header_offset):
+            with zipfile.ZipFile(BytesIO(s), "r") as zipped:
+                return zipped.infolist()
+        pos += _CENTRALHEADER.size
+        filename = s[pos:pos + namelen]
+        pos += namelen
+        info = zipfile.ZipInfo(
+            filename.decode("utf-8" if flag_bits & 0x800 else "cp437"))
+        info.extra = s[pos:pos + extralen]
+        pos += extralen
+        info.comment = s[pos:pos + commentlen]
+        pos += commentlen
+        info.create_version = create_version
+        info.create_system = create_system
+        info.extract_version = extract_version
+        info.reserved = reserved
+        info.flag_bits = flag_bits
+        info.compress_type = compress_type
+        info.date_time = ((dosdate >> 9) + 1980, (dosdate >> 5) & 0xF,
+                          dosdate & 0x1F, dostime >> 11,
+                          (dostime >> 5) & 0x3F, (dostime & 0x1F) * 2)
+        info.CRC = crc
+        info.compress_size = compress_size
+        info.file_size = file_size
+        info.volume = volume
+        info.internal_attr = internal_attr
+        info.external_attr = external_attr
+        info.header_offset = header_offset + concat
+        infos.append(info)
+    return infos
+
+def _dataoffset(s, info):
+    '''Return the offset of the (compressed) data of a member in s.'''
+    try:
+        header = _LOCALHEADER.unpack_from(s, info.header_offset)
+    except struct.error:
+        raise zipfile.BadZipFile("Truncated file header")
+    if header[0] != b"PK\x03\x04":
+        raise zipfile.BadZipFile("Bad magic number for file header")
+    # the name and extra field lengths of the local header may differ from
+    # the ones in the central directory
+    return info.header_offset + _LOCALHEADER.size + header[10] + header[11]
+
+class _fallbackreader(object):
+    '''Read archive members through zipfile.ZipFile.
+
+    The ZipFile is opened on first use and shared by all members of one
+    filter call, so the central directory is parsed at most once.'''
+
+    def __init__(self, s):
+        self._s = s
+        self._zipped = None
+        self._lock = threading.Lock()
+
+    def read(self, info):
+        # reads are serialized: ZipFile.open does not count the users of
+        # its file object in a thread safe way
+        with self._lock:
+            if self._zipped is None:
+                self._zipped = zipfile.ZipFile(BytesIO(self._s), "r")
+            # read by ZipInfo, a name may be used by several members
+            return self._zipped.read(info)
+
+    def close(self):
+        if self._zipped is not None:
+            self._zipped.close()
+
+def _readmember(s, fallback, info):
+    '''Return the uncompressed content of an archive member.
+
+    STORED and DEFLATED members are taken from s directly, everything
+    else (e.g. bzip2 or encrypted members) is read through the
+    _fallbackreader.'''
+    if (info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+            or info.flag_bits & 0x1):
+        return fallback.read(info)
+    start = _dataoffset(s, info)
+    if info.compress_type == zipfile.ZIP_STORED:
+        data = s[start:start + info.file_size]
+    else:
+        # decompress from a view to avoid copying the compressed data
+        data = _inflate(memoryview(s)[start:start + info.compress_size],
+                        info.file_size)
+    if len(data) != info.file_size or _crc32(data) != info.CRC:
+        raise zipfile.BadZipFile("Bad CRC-32 for file %r" % info.filename)
+    return data
+
+def _isencoded(s, infos):
+    '''Tell if the archive s already is in the form written by the encode
+    filter: no compressed members and no adjacent tags in XML members.'''
+    # check all compression methods first, they are known without touching
+    # the member data and rule out any archive saved by an application
+    for info in infos:
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            return False
+    for info in infos:
+        if info.filename.endswith(_XMLSUFFIXES):
+            start = _dataoffset(s, info)
+            if s.find(_XMLTAGS, start, start + info.file_size) != -1:
+                return False
+    return True
+
+def _encodemember(s, fallback, archive_member_info):
+    '''Read an archive member for uncompressed storage.'''
+    original = _readmember(s, fallback, archive_member_info)
+    archive_member = original
+    # set to no compression
+    archive_member_info.compress_type = zipfile.ZIP_STORED
+    # We must take care of none XML files (printersettings.bin)
+    if archive_member_info.filename.endswith(_XMLSUFFIXES):
+        # Split lines for better diffs
+        archive_member = _splitxml(archive_member)
+    return _member(archive_member_info, archive_member, archive_member,
+                   original)
+
+def _decodemember(s, fallback, level, archive_member_info):
+    '''Read an archive member and compress it.'''
+    original = _readmember(s, fallback, archive_member_info)
+    archive_member = original
+    # set compression level 
+    # (a docx file will be smaller than the one created by Microsoft Word)
+    archive_member_info.compress_type = zipfile.ZIP_DEFLATED
+    if archive_member_info.filename.endswith(_XMLSUFFIXES):
+        # Revert splitted lines
+        archive_member = _joinxml(archive_member)
+    return _member(archive_member_info, archive_member,
+                   _deflate(archive_member, level), original)
 
 def zipdocencode(s, cmd, **kwargs):
     '''Encode filter: uncompresses the zipped document format when writing
     to the repository.'''
-    # wrap string representation of the file provided by Mercurial
-    # in a file-like object that can be used with zipfile
-    infile = BytesIO(s)
-    # open the file as a zip archive
+    # read the members of the zip archive from the string representation
+    # of the file provided by Mercurial
     # if the file is not a zip archive (e.g. because the file is a link having
     # the same extension) just use the regular file's string representation
     try:
-        zipped = zipfile.ZipFile(infile, "r")
+        archive_member_infos = _infolist(s)
     except zipfile.BadZipfile:
         # use note level instead of warn: 
         # a warning might irritate users although there is not really a
         # problem as the file will still be version controlled unfiltered
         # without the improved delta compression. The only problem is a
         # broken zip but thats beyond our scope.
-        kwargs["ui"].note(_("zipdoc: Skipped encoding '" + kwargs["filename"]
+        kwargs["ui"].note(_("zipdoc: Skipped encoding '%s"
                 + "' due to bad ZIP archive. The file is not a ZIP"
-                + " (might be a link) or the archive is broken.\n"))
+                + " (might be a link) or the archive is broken.\n")
+                % kwargs["filename"])
+        return s
+    # nothing to do if the file is committed again unchanged
+    if _isencoded(s, archive_member_infos):
+        kwargs["ui"].debug(_("zipdoc: %s is already encoded\n")
+                           % kwargs["filename"])
         return s
-    archive_member_infos = zipped.infolist()
     
-    # string wrapper for the output file to return to Mercurial
-    outfile = BytesIO()
-    uncompressed = zipfile.ZipFile(outfile, "w", zipfile.ZIP_STORED)
-        
-    for archive_member_info in archive_member_infos:  
-        archive_member = zipped.read(archive_member_info)        
-        # set to no compression
-        archive_member_info.compress_type = 0
-        # We must take care of none XML files (printersettings.bin)
-        if archive_member_info.filename.lower().endswith('.xml'):
-            # Split lines for better diffs
-            uncompressed.writestr(archive_member_info,
-                                  archive_member.replace(b"><", b">\r\n <"))
-        else:
-            uncompressed.writestr(archive_member_info, archive_member)
-    zipped.close()    
-    uncompressed.close()
-    infile.close()
+    fallback = _fallbackreader(s)
+    try:
+        members = _map(functools.partial(_encodemember, s, fallback),
+                       archive_member_infos)
+    finally:
+        fallback.close()
     
-    outs = outfile.getvalue()    
-    outfile.close()
+    outs = _writezip(members)
     kwargs["ui"].debug(_("zipdoc: Encoded %s\n") % kwargs["filename"])
     return outs
 
 def zipdocdecode(s, cmd, **kwargs):
     '''Decode filter: compresses the zipped document format when reading from
     the repository.'''
-    infile = BytesIO(s)
     try:
-        uncompressed = zipfile.ZipFile(infile, "r")
+        archive_member_infos = _infolist(s)
     except zipfile.BadZipfile:
         kwargs["ui"].note(_("zipdoc: Skipped decoding '%s"
                 + "' due to bad ZIP archive. The file is not a ZIP"
                 + " (might be a link) or the archive is broken.\n")
                 % kwargs["filename"])
         return s        
-    archive_member_infos = uncompressed.infolist()
-    
-    outfile = BytesIO()
-    zipped = zipfile.ZipFile(outfile, "w", zipfile.ZIP_DEFLATED)
-    
-    for archive_member_info in archive_member_infos:     
-        archive_member = uncompressed.read(archive_member_info)
-        # set compression level 
-        # (a docx file will be smaller than the one created by Microsoft Word)
-        archive_member_info.compress_type = zipfile.ZIP_DEFLATED
-        if archive_member_info.filename.lower().endswith('.xml'):
-            # Revert splitted lines
-            zipped.writestr(archive_member_info,
-                            archive_member.replace(b">\r\n <", b"><"))
-        else:
-            zipped.writestr(archive_member_info, archive_member)
-    zipped.close()    
-    uncompressed.close()
-    infile.close()
+    level = kwargs["ui"].configint(b'zipdoc', b'level')
+    if level is None:
+        level = _LEVEL
+    elif level not in _LEVELS:
+        raise error.ConfigError(
+            _("zipdoc.level must be between %d and %d with %s, got %d")
+            % (_LEVELS[0], _LEVELS[-1], _BACKEND, level))
     
-    outs = outfile.getvalue()    
-    outfile.close()
+    fallback = _fallbackreader(s)
+    try:
+        members = _map(functools.partial(_decodemember, s, fallback, level),
+                       archive_member_infos)
+    finally:
+        fallback.close()
+    
+    outs = _writezip(members)
     kwargs["ui"].debug(_("zipdoc: Decoded %s\n") % kwargs["filename"])
     return outs
 
-
 # define the filter names that are used in the [encode] and [decode] sections
 _filters = {
     b'zipdocencode': zipdocencode,